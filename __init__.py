@@ -1,2 +1,7 @@
-from .lisemrunner import LisemRunner, nse
+from .lisemrunner import LisemRunner, nse, metrics
 from .tablerunner import TableRunner
+from .multievent import MultiEventObjective, Event
+from .resultextractor import ResultExtractor, ResultBundle, efficiency
+from .simulationstore import SummaryStore, TopNStore, QuantisedStore, read_store
+from .multifidelity import SuccessiveHalving
+from .warmstart import RunArchive
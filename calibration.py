@@ -1,20 +1,37 @@
 import sys
 import os
+import copy
 import pandas as pd
 import numpy as np
-from lisemrunner import LisemRunner
+from multiprocessing.pool import ThreadPool
+from lisemrunner import LisemRunner, file_fingerprint
 
 class LisemKOptimizer:
 
-    def __init__(self, lisemrunner:LisemRunner,  obs_file):
+    def __init__(self, lisemrunner:LisemRunner,  obs_file, objective=None, archive=None, catchment=None):
+        """
+        Args:
+            lisemrunner: The runner of the calibrated runfile
+            obs_file: Path to the observation CSV file
+            objective: Optional multi event objective (see multievent.MultiEventObjective). If given, each k
+                is evaluated with the objective instead of the runner and the observation file
+            archive: Optional RunArchive (see warmstart.py) of prior runs. Known k values are not run again
+                and the prior runs narrow the initial range of the optimizers
+            catchment: Name of the catchment in the archive, defaults to the model directory of the runfile.
+                Runs are archived with the name and a hash of the runfile and a hash of the observation file or
+                the multi event objective, so only runs with the same settings are reused
+        """
         self.runner = lisemrunner
         self.runner_base_name = self.runner.name
         self.obs_file = obs_file
+        self.objective = objective
+        self.archive = archive
+        self.catchment = catchment or self.runner.path.parent.absolute().as_posix()
 
     def regulaFalsi_k(self, min_k, max_k, epsilon, num_steps: int):
         """
         Implements regula Falsi method to find the optimal 'k' value by iterating through a range of 'k' values.
-        Calls the open_lisem, filterdata, and nse functions(Bias).
+        Uses the serial (one core) version of `multisection_k`, with the Illinois modification.
 
         Args:
             min_k (float): Minimum value of 'k' to start the iteration.
@@ -25,34 +42,101 @@ class LisemKOptimizer:
             float: Optimal 'k' value.
 
         """
-        round=0
-        f_min_k = self.run_k(min_k)[1]
-        f_max_k = self.run_k(max_k)[1]
-        if f_min_k * f_max_k >= 0: 
-            print("You have not assumed right a and b") 
+        try:
+            c, history = self.multisection_k(min_k, max_k, epsilon, num_steps, ncores=1)
+        except ValueError as e:
+            print("You have not assumed right a and b:", e)
             return -1
-        c = min_k # Initialize result 
-          
-        for i in range(num_steps): 
-            round += 1
-            # Find the point that touches x-axis 
-            c = (min_k * f_max_k - max_k * f_min_k)/ (f_max_k - f_min_k) 
-            f_opt_k = self.run_k(c)[1] 
-            print(
-                 f'round = {round}, k = {c}, bias={f_opt_k}') 
-            # Check if the above found point is the root 
-            if abs(f_opt_k) < epsilon:
-                break
-            
-            # Decide the side to repeat the steps 
-            elif (f_opt_k  * f_min_k) < 0: 
-                max_k = c 
-                f_max_k = f_opt_k
-            else: 
-                min_k = c 
-                f_min_k = f_opt_k
         print("The value of k_opt is : " , '%.4f' %c)
-        
+        return c
+
+    def multisection_k(self, min_k, max_k, epsilon, max_iter: int, ncores: int = None, xtol: float = None):
+        """
+        Finds the k value with pBias = 0 with a parallel bracketing method. Each iteration runs one
+        regula falsi (Illinois) estimate and ncores - 1 equally spaced k values of the bracket at the same time
+        and continues with the sub-interval with a sign change of pBias. With one core, a bisection step is used,
+        if the last step did not halve the bracket.
+
+        Args:
+            min_k (float): Minimum value of 'k', the lower end of the bracket.
+            max_k (float): Maximum value of 'k', the upper end of the bracket.
+            epsilon (float): Stops when abs(pBias) is smaller or equal
+            max_iter (int): Maximum number of iterations
+            ncores (int): Number of parallel runs per iteration, defaults to the number of cpus
+            xtol (float): Stops when the bracket is smaller, the minimum distance of two k values in an iteration.
+                Defaults to the resolution of the values in the runfile (see LisemRunner.precision), it can not be smaller.
+                All k values are rounded to this resolution, so that each run is a different runfile
+
+        Returns:
+            k, history: The k value with the smallest abs(pBias) and a dataframe of all runs
+
+        Raises:
+            ValueError: If pBias has the same sign (or is nan) at both ends of the bracket, or if no sign change
+                is left in the bracket, because runs failed (nan)
+        """
+        ncores = ncores or os.cpu_count() or 1
+        resolution = 10 ** -self.runner.precision
+        # Distances of values on the runfile grid are compared with half a grid step of tolerance
+        xtol = max(xtol or resolution, resolution) - resolution / 2
+        if self.archive is not None:
+            min_k, max_k = self.archive.bracket(*self._archive_key(), min_k, max_k) or (min_k, max_k)
+        history = []
+
+        def evaluate(k_values, iteration):
+            with ThreadPool(len(k_values)) as pool:
+                results = pool.map(self.run_k, k_values)
+            for k, (nse, bias) in zip(k_values, results):
+                history.append(dict(iteration=iteration, k=k, NSE=nse, pBias=bias))
+                print(f'round = {iteration}, k = {k}, bias={bias}')
+            return [bias for nse, bias in results]
+
+        def result():
+            df = pd.DataFrame(history)
+            return df.k[df.pBias.abs().idxmin()], df
+
+        a, b = self.runner.runfile_value(min_k), self.runner.runfile_value(max_k)
+        fa, fb = evaluate([a, b], 0)
+        if abs(fa) <= epsilon or abs(fb) <= epsilon:
+            return result()
+        if not fa * fb < 0:
+            raise ValueError(f'pBias has the same sign for k={a} ({fa}) and k={b} ({fb})')
+        # Weighted function values of the Illinois method
+        wa, wb = fa, fb
+        bisect = False
+        for iteration in range(1, max_iter + 1):
+            width = b - a
+            c = (a + b) / 2 if bisect else (a * wb - b * wa) / (wb - wa)
+            points = np.append(np.linspace(a, b, ncores + 1)[1:-1], c)
+            # An estimate rounded to an end of the bracket is moved one grid step inside
+            points = [min(max(k, a + resolution), b - resolution) for k in points]
+            k_values = []
+            for k in sorted(self.runner.runfile_value(k) for k in points):
+                if a + xtol < k < b - xtol and all(abs(k - v) > xtol for v in k_values):
+                    k_values.append(k)
+            if not k_values:
+                break
+            f_values = evaluate(k_values, iteration)
+            # An exact zero is a root for any epsilon
+            if any(abs(f) <= epsilon for f in f_values):
+                break
+            # The sub-interval with the sign change, failed runs (nan) are skipped
+            ks, fs = zip(*[(k, f) for k, f in zip([a] + k_values + [b], [fa] + f_values + [fb]) if not np.isnan(f)])
+            changes = [i for i in range(len(ks) - 1) if fs[i] * fs[i + 1] < 0]
+            if not changes:
+                raise ValueError(f'No sign change of pBias left in [{a}, {b}], runs failed: {history[-len(k_values):]}')
+            i = changes[0]
+            new_a, new_b = ks[i], ks[i + 1]
+            # Illinois: halve the weight of an end of the bracket, that is kept
+            wa = wa / 2 if new_a == a else fs[i]
+            wb = wb / 2 if new_b == b else fs[i + 1]
+            a, b, fa, fb = new_a, new_b, fs[i], fs[i + 1]
+            bisect = ncores == 1 and (b - a) > width / 2
+            for row in history[-len(k_values):]:
+                row.update(low=a, high=b)
+            if b - a < xtol + resolution / 2:
+                break
+        return result()
+
     def opt_k(self, min_k, max_k, num_steps: int):
         """
         Implements the Try and Error method to find the optimal 'k' value by iterating through a range of 'k' values.
@@ -70,10 +154,12 @@ class LisemKOptimizer:
         round = 0
         max_result = 0.0
         k_opt = None
+        if self.archive is not None:
+            min_k, max_k = self.archive.narrow(*self._archive_key(), min_k, max_k)
         while True:
             step = (max_k - min_k) / (num_steps - 1)  # Calculate the step size
-            # Generate the 'k' values
-            k_values = [min_k + step * i for i in range(num_steps)]
+            # Generate the 'k' values as written to the runfile
+            k_values = [self.runner.runfile_value(min_k + step * i) for i in range(num_steps)]
             #k_values  = np.random.uniform(min_k, max_k, size = num_steps)
             results = self.run_opt_round(k_values, round)
             # Find the maximum value in the 'results' list
@@ -93,25 +179,51 @@ class LisemKOptimizer:
     def run_opt_round(self, k_values: list, round_no: int):
         results = []
         for run_no, k in enumerate(k_values):
-            results.append(self.run_k(k)[0])
+            results.append(self.run_k(k, incumbent=max(results, default=None))[0])
             print(
                 f'round = {round_no}, run = {run_no}/{len(k_values)}, k = {k_values[run_no]}')
         return results
         
  
-    def run_k(self, k):
+    def _archive_key(self) -> tuple:
+        """catchment, runfile, objective and parameter of the runs in the archive"""
+        runfile = f'{self.runner_base_name}:{self.runner.fingerprint(exclude=("ksat",))}'
+        if self.objective is not None:
+            objective = self.objective.identity(exclude=('ksat',))
+        else:
+            objective = 'obs:' + file_fingerprint(self.obs_file)
+        return self.catchment, runfile, objective, 'ksat'
+
+    def run_k(self, k, incumbent=None):
         """
         Runs lisem with a specific k value and returns the nse and bias of that run
 
+        With a multi event objective the aggregated score is returned instead of the nse. The incumbent
+        score is used by the objective to stop runs early, that can not beat it.
 
         Returns
         -------
         nse, bias (float)
 
         """
-        self.runner.name = self.runner_base_name + f'_k_{k:0.4f}'
-        output_df = self.runner.run(ksat=k)
-        return self.nse(obs_file, output_df)
+        # The value written to the runfile is used for the archive and the run
+        k = self.runner.runfile_value(k)
+        if self.archive is not None:
+            prior = self.archive.lookup(*self._archive_key(), k)
+            if prior is not None:
+                return prior
+        if self.objective is not None:
+            nse, bias = self.objective(incumbent=incumbent, ksat=k)
+        else:
+            # A copy of the runner per k value, so that several k values can run at the same time
+            runner = copy.copy(self.runner)
+            runner.name = self.runner_base_name + f'_k_{k:0.4f}'
+            output_df = runner.run(ksat=k)
+            nse, bias = self.nse(self.obs_file, output_df)
+        # Runs stopped early by the objective have no bias and are not archived
+        if self.archive is not None and not np.isnan(bias):
+            self.archive.record(*self._archive_key(), k, nse, bias)
+        return nse, bias
 
 
     def nse(self, obs_file, output_df):
@@ -10,9 +10,58 @@ import numpy as np
 import locale
 import logging
 import shutil
+import subprocess
+import time
+import hashlib
 
 logger = logging.getLogger(__name__)
 
+
+def file_fingerprint(path) -> str:
+    """A short hash of the content of a file, eg. an observation file"""
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()[:16]
+
+
+def runfile_fingerprint(runfile: str, exclude=()) -> str:
+    """
+    A short hash of the content of a runfile, without the result directory and the excluded parameters
+
+    Args:
+        runfile: The text of the runfile
+        exclude: Names (or aliases) of parameters, which are not part of the hash
+    """
+    exclude = {LisemRunner.alias.get(e, e.replace('_', ' ')) for e in exclude} | {'Result Directory'}
+    lines = [line for line in runfile.splitlines() if line.split('=')[0].strip() not in exclude]
+    return hashlib.sha1('\n'.join(lines).encode()).hexdigest()[:16]
+
+
+def wait_usage(process: subprocess.Popen, block=True):
+    """
+    Waits for a Lisem process and returns its resource usage. Uses os.wait4 where available, on other
+    systems (Windows) the usage values are nan.
+
+    Args:
+        process: The Lisem process, eg. from LisemRunner.start
+        block: If False, returns None when the process is still running
+
+    Returns:
+        dict with peak_rss (bytes), cpu_time (s) and io_bytes or None
+    """
+    nan = float('nan')
+    if not hasattr(os, 'wait4') or process.returncode is not None:
+        returncode = process.wait() if block else process.poll()
+        if returncode is None:
+            return None
+        return dict(peak_rss=nan, cpu_time=nan, io_bytes=nan)
+    pid, status, ru = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux, block counts are in 512 byte units
+    peak_rss = ru.ru_maxrss if sys.platform == 'darwin' else ru.ru_maxrss * 1024
+    return dict(peak_rss=peak_rss, cpu_time=ru.ru_utime + ru.ru_stime, io_bytes=(ru.ru_inblock + ru.ru_oublock) * 512)
+
+
 class LisemRunner:
     """
     Wraps the Lisem model and its runfile in a python style
@@ -42,6 +91,13 @@ class LisemRunner:
 
     >>> lr.run(ksat=2)
 
+    Spatially distributed parameters are changed with a `ParameterMaps` object (see parametermaps.py). The
+    changed maps are written into the result directory of the run:
+
+    >>> lr = LisemRunner('C:/path/to/Lisem.exe', 'path/to/runfile_template.run', name='variant',
+    ...                  parameter_maps=ParameterMaps('path/to/maps', zones='landuse.map'))
+    >>> lr.run(maps={'ksat1.map': {1: 0.5, 2: 1.2}})
+
     """
     alias = dict(
         ksat='Ksat calibration',
@@ -51,8 +107,10 @@ class LisemRunner:
         n_cores='Nr user Cores',
         adv_options = 'Advanced Options',
     )
+    # Number of decimals of float parameters written to the runfile
+    precision = 2
 
-    def __init__(self, lisempath, runfile, name, resultpath=None, silent=False):
+    def __init__(self, lisempath, runfile, name, resultpath=None, silent=False, parameter_maps=None, timeout=None):
         """
         Creates the Lisem wrapper
         Args:
@@ -62,6 +120,8 @@ class LisemRunner:
                 For parallel execution, make sure to use unique names
             virtual_frame_buffer: A boolean flag to indicate if Lisem should be run in a virtual framebuffer for speed up
                                 and to run on headless systems. Ignored on non-posix systems
+            parameter_maps: A ParameterMaps object to change maps per run, used by the maps argument of `run`
+            timeout: Maximum run time of Lisem in seconds. `run` kills Lisem and raises subprocess.TimeoutExpired after it
         """
         locale.setlocale(locale.LC_NUMERIC, '')
         self.runfile = Path(runfile).read_text()
@@ -76,6 +136,16 @@ class LisemRunner:
         self['Advanced Options'] = 1
         self['n_cores'] = 1
         self.silent = silent
+        self.parameter_maps = parameter_maps
+        self.timeout = timeout
+        # Resource usage of the last run, see wait_usage
+        self.usage = None
+        # The map directory of the template, restored for runs without changed maps
+        try:
+            self.template_map_dir = self['Map Directory']
+        except KeyError:
+            self.template_map_dir = None
+        self._maps_written = False
 
     def __getitem__(self, item):
         item = self.alias.get(item, item.replace('_', ' '))
@@ -97,7 +167,7 @@ class LisemRunner:
         # Use os locale to convert float to str
         # Check for float and any np.float: https://stackoverflow.com/questions/28292542/how-to-check-if-a-number-is-a-np-float64-or-np-float32-or-np-float16
         if isinstance(value, (np.floating, float)):
-            value = locale.format('%0.2f', value)
+            value = locale.format_string(f'%0.{self.precision}f', value)
         else:
             value = str(value)
         logger.info(item, '=', value)
@@ -108,6 +178,11 @@ class LisemRunner:
             raise KeyError(f'{item} is duplicated')
         self.runfile = new_runfile
 
+    @classmethod
+    def runfile_value(cls, value: float) -> float:
+        """The float value as written to the runfile, eg. 1.99 for 1.995"""
+        return float(f'%0.{cls.precision}f' % float(value))
+
     def __contains__(self, item):
         return item in list(self.keys())
 
@@ -126,6 +201,10 @@ class LisemRunner:
         for m in re.finditer('(.*)=(.*)', self.runfile, flags=re.MULTILINE):
             yield m.group(2)
 
+    def fingerprint(self, exclude=()) -> str:
+        """A short hash of the runfile without the result directory and the excluded parameters"""
+        return runfile_fingerprint(self.runfile, exclude)
+
     def __str__(self):
         return f'LisemRunner(name={self.name}, result_path={self.result_path.as_posix()}, run_path={self.runfilename().as_posix()})'
 
@@ -144,10 +223,10 @@ class LisemRunner:
 
     def clean(self):
         """
-        Deletes the saved runfile and all results
+        Deletes the saved runfile and all results. Missing files are ignored, eg. of a killed run
         """
-        shutil.rmtree(self.result_path / self.name)
-        self.runfilename().unlink()
+        shutil.rmtree(self.result_path / self.name, ignore_errors=True)
+        self.runfilename().unlink(missing_ok=True)
 
     def get_result(self):
         """
@@ -171,41 +250,101 @@ class LisemRunner:
         filtered_df.reset_index(drop=True, inplace=True)
         return filtered_df
 
+    def extract(self, extractor, time=None):
+        """
+        Reads several variables of the result file in one pass with a ResultExtractor (see resultextractor.py)
+
+        Args:
+            extractor: The ResultExtractor defining the variables
+            time: Optional observation time, the variables are interpolated to
 
-    def run(self, **kwargs) -> pd.DataFrame:
+        Returns:
+            ResultBundle
         """
-        Saves the modified runfile and starts Lisem. On Posix systems usually without a GUI
-        
-        Returns the filtered result
+        return extractor.read(self['Result Directory'] + 'totalseries.csv', time)
+
+
+    def write_maps(self, maps: dict):
+        """
+        Writes the changed maps of this run into the result directory and points the runfile to them
+
+        Args:
+            maps: dict of mapname -> multiplier, see ParameterMaps.multiplied
         """
+        if self.parameter_maps is None:
+            raise ValueError(f'{self} has no parameter maps')
+        if not self._maps_written:
+            # Keeps changes of the map directory since the creation of the runner
+            self.template_map_dir = self['Map Directory']
+        map_dir = self.parameter_maps.write(self.result_path / self.name / 'maps', maps)
+        self['Map Directory'] = map_dir.absolute().as_posix() + '/'
+        self._maps_written = True
+
+    def restore_maps(self):
+        """Points the runfile back to the template map directory after a run with changed maps"""
+        if self._maps_written:
+            self['Map Directory'] = self.template_map_dir
+            self._maps_written = False
+
+    def start(self, maps=None, **kwargs) -> subprocess.Popen:
+        """
+        Saves the modified runfile and starts Lisem without waiting for the end of the run.
+        Use `get_result` after the process has finished.
+
+        Args:
+            maps: Optional dict of mapname -> multiplier, applied with the parameter maps of the runner
+            **kwargs: Parameters of the runfile
+
+        Returns the Lisem process
+        """
+        self.restore_maps()
         for k, v in kwargs.items():
             self[k] = v
+        if maps:
+            self.write_maps(maps)
         self.save()
         os.makedirs(self.result_path, exist_ok=True)
 
-        run_args = [str(self.lisempath.absolute())]
+        run_args = [str(self.lisempath.absolute()), '-r', str(self.runfilename().absolute())]
+        logger.info('$ %s', ' '.join(run_args))
+        output = subprocess.DEVNULL if self.silent else None
+        return subprocess.Popen(run_args, stdout=output, stderr=output)
+
+    def run(self, maps=None, **kwargs) -> pd.DataFrame:
+        """
+        Saves the modified runfile and starts Lisem. On Posix systems usually without a GUI
 
-        run_args.extend(['-r', str(self.runfilename().absolute())])
-        if self.silent:
-            run_args.append('>/dev/null 2>/dev/null')
-        logger.info('$', ' '.join(run_args))
-        os.system(' '.join(run_args))
+        Args:
+            maps: Optional dict of mapname -> multiplier, applied with the parameter maps of the runner
+            **kwargs: Parameters of the runfile
+
+        Returns the filtered result
+        """
+        process = self.start(maps, **kwargs)
+        start = time.monotonic()
+        while True:
+            self.usage = wait_usage(process, block=self.timeout is None)
+            if self.usage is not None:
+                break
+            if time.monotonic() - start > self.timeout:
+                process.kill()
+                self.usage = wait_usage(process)
+                raise subprocess.TimeoutExpired(process.args, self.timeout)
+            time.sleep(0.1)
         return self.get_result()
-    
-    
 
-def nse(obs_file, output_df):
+
+def metrics(obs_file, output_df) -> dict:
     """
-    Calculates the Nash-Sutcliffe Efficiency (NSE) using observation and simulation data from CSV files.
+    Calculates the objective functions using observation and simulation data.
     Parameters:
         obs_file (str): Path to the observation CSV file.
         output_df (pd.DataFrame): A dataframe containing the simulation result, as prepared by filterdata
 
     Returns:
-        float: Nash-Sutcliffe Efficiency (NSE) value.
+        dict: Nash-Sutcliffe Efficiency (NSE), percentage of bias (pBias) and Kling-Gupta Efficiency (KGE)
 
     """
-    import numpy as np
     obs_df = pd.read_csv(obs_file)
     # Calculate the values of the hydrograph from the cumulative values
     obs_df['Channels'] = obs_df['Channels'].diff().fillna(obs_df['Channels'])
@@ -224,8 +363,23 @@ def nse(obs_file, output_df):
     beta = output_df.Channels.mean() / obs_df.Channels.mean()
     # Calculate Kling-Gupta Efficiency (KGE)
     kge_value = 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2)
-    logger.info('Nash-Sutcliffe Efficiency:', nse, 'pBias:', pbias , 'Kling-Gupta Efficiency (KGE):', kge_value )
-    return nse, pbias
+    logger.info('Nash-Sutcliffe Efficiency: %s pBias: %s Kling-Gupta Efficiency (KGE): %s', nse, pbias, kge_value)
+    return dict(NSE=nse, pBias=pbias, KGE=kge_value)
+
+
+def nse(obs_file, output_df):
+    """
+    Calculates the Nash-Sutcliffe Efficiency (NSE) using observation and simulation data from CSV files.
+    Parameters:
+        obs_file (str): Path to the observation CSV file.
+        output_df (pd.DataFrame): A dataframe containing the simulation result, as prepared by filterdata
+
+    Returns:
+        float: Nash-Sutcliffe Efficiency (NSE) value.
+
+    """
+    m = metrics(obs_file, output_df)
+    return m['NSE'], m['pBias']
 
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ import pandas as pd
 import numpy as np
 import tables
 from .lisemrunner import LisemRunner
+from .multievent import MultiEventObjective
 
 def u(vmin, vmax, default=None, doc=None):
     """
@@ -41,15 +42,22 @@ class Parameters:
 
 
 class LisemSpot:
+    """
+    The spotpy setup for a single Lisem runfile.
+
+    With a simulation store (see simulationstore.py) and dbformat='custom' for the sampler, the results are
+    saved by the store instead of the spotpy database, eg. only the hydrographs of the best runs
+    """
     parameters = Parameters()
 
-    def __init__(self, lisempath, runfile, name, resultpath, observation_file, silent=False) -> None:
+    def __init__(self, lisempath, runfile, name, resultpath, observation_file, silent=False, store=None) -> None:
         self.lisempath = lisempath
         self.runfile = runfile
         self.name = name
         self.resultpath = resultpath
         self.obs_df = pd.read_csv(observation_file)
         self.silent = silent
+        self.store = store
 
 
     def _lisem_runner_factory(self, id: int):
@@ -72,6 +80,45 @@ class LisemSpot:
     def evaluation(self):
         return np.array(self.obs_df.Channels)[:-1]
 
+    def save(self, objectivefunctions, parameter, simulations, *args, **kwargs):
+        """Called by spotpy with dbformat='custom', forwards the run to the store"""
+        if self.store is None:
+            raise ValueError('dbformat="custom" needs a simulation store for LisemSpot')
+        names = [p.name for p in self.parameters]
+        self.store.save(objectivefunctions, dict(zip(names, parameter)), simulations)
+
+
+class MultiEventSpot:
+    """
+    A spotpy setup for the joint calibration of several events with a MultiEventObjective.
+
+    The simulation of a parameter set is the vector of the per event scores (nan for events stopped early),
+    the evaluation is the vector of the event weights. The objective functions are the aggregated score
+    and the weighted pBias.
+    """
+    parameters = Parameters()
+
+    def __init__(self, objective: MultiEventObjective) -> None:
+        self.objective = objective
+        self.best = None
+
+    def simulation(self, vector: Parameters):
+        alias = {p.name: p.description for p in self.parameters}
+        parameters = {alias.get(k, k): v for k, v in zip(vector.name, vector.random)}
+        result = self.objective.evaluate(incumbent=self.best, **parameters)
+        return np.concatenate([result[self.objective.metric].to_numpy(), result.pBias.to_numpy()])
+
+    def objectivefunction(self, simulation, evaluation):
+        n = len(evaluation)
+        score = self.objective.upper_bound(simulation[:n])
+        pbias = float(np.sum(evaluation * simulation[n:]) / np.sum(evaluation))
+        if not np.isnan(simulation[:n]).any() and (self.best is None or score > self.best):
+            self.best = score
+        return [score, pbias]
+
+    def evaluation(self):
+        return self.objective.weights
+
 
 def read_h5(filename):
     """
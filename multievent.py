@@ -0,0 +1,159 @@
+"""
+Joint calibration on several storm events or catchments.
+
+For each parameter set all event runfiles are started in parallel and the objective functions
+of the events are aggregated with weights.
+"""
+from pathlib import Path
+from collections import deque
+import typing
+import time
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .lisemrunner import LisemRunner, metrics, file_fingerprint, runfile_fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class Event(typing.NamedTuple):
+    """A single calibration event: runfile, observation file and the weight of the event"""
+    runfile: str
+    observation: str
+    weight: float = 1.0
+    name: str = None
+
+
+class MultiEventObjective:
+    """
+    Calculates a weighted objective function over several events.
+
+    Usage:
+
+    >>> obj = MultiEventObjective('C:/path/to/Lisem.exe', [Event('run/storm1.run', 'obs1.csv', 2.0),
+    ...                                                     Event('run/storm2.run', 'obs2.csv')])
+    >>> score, pbias = obj(ksat=2.5)
+
+    NSE and KGE have an upper limit of 1. When an incumbent score is given, the remaining runs are stopped
+    as soon as the aggregated score could not beat the incumbent even if all missing events reach 1.
+    In that case the returned score is this upper limit, which is always below the incumbent.
+    """
+
+    def __init__(self, lisempath, events: typing.Sequence[Event], resultpath=None, metric='NSE',
+                 ncores: int = None, silent=True, clean=True, poll_interval: float = 1.0):
+        """
+        Args:
+            lisempath: Path to the Lisem executable
+            events: Sequence of Event tuples (or tuples of runfile, observation[, weight[, name]])
+            resultpath: Result directory for all runs, by default the res directory beside each run directory
+            metric: The aggregated objective function, 'NSE' or 'KGE'
+            ncores: Number of events to run at the same time, defaults to the number of events
+            silent: Run Lisem without output
+            clean: Delete the runfiles and results of each run after calculating the objective functions
+                and of the runs stopped early
+            poll_interval: Seconds between checks of the running Lisem processes
+        """
+        if metric not in ('NSE', 'KGE'):
+            raise ValueError(f'Metric {metric} is not supported, use NSE or KGE')
+        self.lisempath = Path(lisempath).absolute()
+        self.events = [Event(*e) for e in events]
+        self.weights = np.array([e.weight for e in self.events], dtype=float)
+        self.resultpath = Path(resultpath).absolute() if resultpath else None
+        self.metric = metric
+        self.ncores = ncores or len(self.events)
+        self.silent = silent
+        self.clean = clean
+        self.poll_interval = poll_interval
+
+    def identity(self, exclude=()) -> str:
+        """
+        A short hash of the objective: metric, weights and the content of the runfiles and observation files
+
+        Args:
+            exclude: Calibrated parameters, that are not part of the runfile hashes
+        """
+        parts = [self.metric] + [
+            f'{runfile_fingerprint(Path(e.runfile).read_text(), exclude)}:{file_fingerprint(e.observation)}:{e.weight}'
+            for e in self.events
+        ]
+        return 'multievent:' + hashlib.sha1('|'.join(parts).encode()).hexdigest()[:16]
+
+    def _event_name(self, index: int, event: Event, parameters: dict) -> str:
+        name = event.name or f'{Path(event.runfile).stem}_{index}'
+        return f'{name}_{hash(str(sorted(parameters.items()))) % 10**8:08d}'
+
+    def _runner(self, index: int, event: Event, parameters: dict) -> LisemRunner:
+        run_path = Path(event.runfile).absolute()
+        res_path = self.resultpath or run_path.parent.parent / 'res'
+        return LisemRunner(self.lisempath, run_path, self._event_name(index, event, parameters), res_path,
+                           silent=self.silent)
+
+    def upper_bound(self, scores: np.ndarray) -> float:
+        """
+        The best reachable aggregated score, if all events without a score (nan) reach the optimum of 1
+        """
+        return float(np.sum(self.weights * np.where(np.isnan(scores), 1.0, scores)) / self.weights.sum())
+
+    def evaluate(self, incumbent: float = None, **parameters) -> pd.DataFrame:
+        """
+        Runs all events with the given parameters in parallel
+
+        Args:
+            incumbent: The best aggregated score so far. If given, stops early when it can not be reached anymore
+            **parameters: Parameters of the runfiles
+
+        Returns:
+            A dataframe with the objective functions of each event. Stopped events have nan values.
+        """
+        result = pd.DataFrame(
+            dict(name=[e.name or Path(e.runfile).stem for e in self.events], weight=self.weights,
+                 NSE=np.nan, pBias=np.nan, KGE=np.nan)
+        )
+        queue = deque(enumerate(self.events))
+        running = []
+        try:
+            while queue or running:
+                while queue and len(running) < self.ncores:
+                    i, event = queue.popleft()
+                    lr = self._runner(i, event, parameters)
+                    running.append((i, lr, lr.start(**parameters)))
+                time.sleep(self.poll_interval)
+                for item in [item for item in running if item[2].poll() is not None]:
+                    running.remove(item)
+                    i, lr, process = item
+                    for k, v in metrics(self.events[i].observation, lr.get_result()).items():
+                        result.loc[i, k] = v
+                    if self.clean:
+                        lr.clean()
+                if incumbent is not None and self.upper_bound(result[self.metric].to_numpy()) < incumbent:
+                    logger.info('Stop remaining events, %s can not beat %s', parameters, incumbent)
+                    break
+        finally:
+            # Kill the runs stopped early (or after an error)
+            for i, lr, process in running:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                if self.clean:
+                    lr.clean()
+        return result
+
+    def aggregate(self, result: pd.DataFrame) -> tuple:
+        """
+        Aggregates the result of `evaluate`
+
+        Returns:
+            score, pBias: The weighted score (or its upper bound, if events are missing) and the weighted pBias
+        """
+        score = self.upper_bound(result[self.metric].to_numpy())
+        pbias = float(np.sum(self.weights * result.pBias.to_numpy()) / self.weights.sum())
+        return score, pbias
+
+    def __call__(self, incumbent: float = None, **parameters) -> tuple:
+        """
+        Runs all events and returns the aggregated score and pBias
+        """
+        return self.aggregate(self.evaluate(incumbent, **parameters))
@@ -0,0 +1,110 @@
+"""
+Multi-fidelity screening of calibration candidates with successive halving.
+"""
+import math
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .tablerunner import TableRunner
+
+logger = logging.getLogger(__name__)
+
+
+class SuccessiveHalving:
+    """
+    Screens many candidates with cheap variants of the runfile and runs only the best of them with the full runfile.
+
+    The candidates are a table in the format of the TableRunner (runfile, observation, name, parameters...).
+    The cheap variants are given as parameter overrides of the runfile, eg. a coarser timestep or a
+    shorter simulation:
+
+    >>> runner = TableRunner('./Lisem', ncores=8, extractor=ResultExtractor(time_offset=1440))
+    >>> sh = SuccessiveHalving(runner, [{'Timestep': 120}, {'Timestep': 60}], eta=3)
+    >>> result = sh(candidates)
+    >>> sh.agreement
+
+    Each level runs the remaining candidates, the best 1/eta of them are promoted to the next level. The last
+    level is always the unchanged runfile. For shortened simulations the objective functions only compare the
+    simulated part of the observation, so the cheap levels are only used to rank the candidates.
+
+    Overrides changing the output interval of the result file (eg. the Timestep) need a TableRunner with a
+    ResultExtractor, which aligns the simulation to the time of the observation. A random control sample of
+    the candidates is run at every level, the Spearman rank correlation of consecutive levels in `agreement`
+    is calculated with this sample, because the promoted candidates cover only the best part of the range.
+    """
+    # Runfile parameters, that change the output interval of the result file
+    interval_keys = ('Timestep',)
+
+    def __init__(self, runner: TableRunner, fidelities: list, eta: float = 3, metric='NSE', min_candidates: int = 1,
+                 control: int = 5, seed=None):
+        """
+        Args:
+            runner: The TableRunner used for all levels
+            fidelities: List of runfile overrides (dict) of the cheap levels, from the cheapest to the most expensive
+            eta: The fraction 1/eta of the candidates is promoted to the next level
+            metric: Column of the runner result used for the ranking, higher is better
+            min_candidates: Minimum number of promoted candidates
+            control: Size of the random control sample, that is run at every level to measure the rank agreement
+            seed: Random seed of the control sample
+        """
+        interval_keys = {k.lower() for k in self.interval_keys}
+        changed = [k for f in fidelities for k in f if k.replace('_', ' ').lower() in interval_keys]
+        if changed and runner.extractor is None:
+            raise ValueError(f'{changed} change the output interval, use a TableRunner with a ResultExtractor')
+        self.runner = runner
+        self.fidelities = list(fidelities) + [{}]
+        self.eta = eta
+        self.metric = metric
+        self.min_candidates = min_candidates
+        self.control = control
+        self.seed = seed
+        self.agreement = None
+
+    def _level_table(self, table: pd.DataFrame, level: int) -> pd.DataFrame:
+        level_table = table.copy()
+        level_table.iloc[:, 2] = level_table.iloc[:, 2].astype(str) + f'_f{level}'
+        for key, value in self.fidelities[level].items():
+            level_table[key] = value
+        return level_table
+
+    def _agreement(self, result: pd.DataFrame) -> pd.DataFrame:
+        rows = []
+        for level in range(len(self.fidelities) - 1):
+            a, b = f'{self.metric}_f{level}', f'{self.metric}_f{level + 1}'
+            both = result.loc[result.control, [a, b]].dropna()
+            # Spearman rank correlation without scipy
+            spearman = both[a].rank().corr(both[b].rank()) if len(both) > 2 else np.nan
+            rows.append(dict(level=level, n=len(both), spearman=spearman))
+        return pd.DataFrame(rows)
+
+    def __call__(self, table: pd.DataFrame) -> pd.DataFrame:
+        """
+        Runs the successive halving for all candidates in the table
+
+        Returns:
+            The table with the metric of each candidate at each level (nan, if the level was not reached),
+            the highest reached level and the membership in the control sample.
+            The rank agreement of consecutive levels is stored in `agreement`.
+        """
+        result = table.copy()
+        result['level'] = -1
+        control = table.sample(min(self.control, len(table)), random_state=self.seed).index
+        result['control'] = result.index.isin(control)
+        promoted = table.index
+        for level, overrides in enumerate(self.fidelities):
+            candidates = table.loc[promoted.union(control, sort=False)]
+            logger.info('Level %s %s: %s candidates', level, overrides, len(candidates))
+            level_result = self.runner(self._level_table(candidates, level))
+            column = f'{self.metric}_f{level}'
+            result[column] = np.nan
+            result.loc[candidates.index, column] = level_result[self.metric]
+            result.loc[candidates.index, 'level'] = level
+            if level + 1 < len(self.fidelities):
+                n = max(self.min_candidates, math.ceil(len(promoted) / self.eta))
+                best = result.loc[promoted, column].sort_values(ascending=False, na_position='last')
+                promoted = best.index[:n]
+        self.agreement = self._agreement(result)
+        logger.info('Rank agreement of the levels:\n%s', self.agreement)
+        return result
@@ -0,0 +1,152 @@
+"""
+Spatially distributed parameter maps for Lisem runs.
+
+Base rasters are loaded once per process and kept in memory. For every run the
+multiplied maps are written into the run's workspace, together with links to the
+unchanged maps of the original map directory.
+"""
+import os
+import shutil
+from pathlib import Path
+import logging
+
+import numpy as np
+import rasterio
+
+logger = logging.getLogger(__name__)
+
+# Raster cache of this process: absolute path -> (mtime, array, profile)
+_raster_cache = {}
+
+
+def load_raster(path):
+    """
+    Loads a single band raster into memory. Repeated calls for an unchanged file return the cached array.
+
+    Args:
+        path: Path to the raster file
+
+    Returns:
+        array, profile. The array is shared between calls and must not be changed in place.
+        The profile of a PCRaster map contains its PCRASTER_VALUESCALE
+    """
+    path = Path(path).absolute()
+    mtime = path.stat().st_mtime
+    cached = _raster_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+    logger.info('Load raster: %s', path)
+    with rasterio.open(path) as src:
+        array = src.read(1)
+        profile = dict(src.profile)
+        if profile['driver'] == 'PCRaster':
+            profile['PCRASTER_VALUESCALE'] = src.tags().get('PCRASTER_VALUESCALE', 'VS_SCALAR')
+    array.setflags(write=False)
+    _raster_cache[path] = (mtime, array, profile)
+    return array, profile
+
+
+class ParameterMaps:
+    """
+    Applies zone wise multipliers to the maps of a Lisem map directory.
+
+    Usage:
+
+    >>> pm = ParameterMaps('path/to/maps', zones='landuse.map')
+    >>> lr = LisemRunner('C:/path/to/Lisem.exe', 'path/to/runfile_template.run', name='variant', parameter_maps=pm)
+    >>> lr.run(maps={'ksat1.map': {1: 0.5, 2: 1.2}})
+
+    A multiplier can either be a scalar for the whole map or a dict of zone id -> multiplier. Zones
+    without an entry keep their original values. Each map written for a run is a new array, the base
+    rasters are never changed.
+    """
+
+    def __init__(self, map_dir, zones=None):
+        """
+        Args:
+            map_dir: The original map directory, usually the 'Map Directory' of the runfile
+            zones: Filename of a zone or land use raster (relative to map_dir) with integer zone ids
+        """
+        self.map_dir = Path(map_dir).absolute()
+        self.zones = zones
+
+    def _zone_array(self):
+        zones, _ = load_raster(self.map_dir / self.zones)
+        return zones
+
+    def multiplied(self, mapname, multiplier) -> tuple:
+        """
+        Calculates the map with the multipliers applied
+
+        Args:
+            mapname: Filename of the map in the map directory
+            multiplier: A scalar or a dict of zone id -> multiplier
+
+        Returns:
+            array, profile
+        """
+        base, profile = load_raster(self.map_dir / mapname)
+        nodata = profile.get('nodata')
+        profile = dict(profile)
+        if profile['driver'] == 'PCRaster':
+            # PCRaster stores real values as 32 bit scalar or direction maps
+            dtype = np.dtype(np.float32)
+            if profile['PCRASTER_VALUESCALE'] not in ('VS_SCALAR', 'VS_DIRECTION'):
+                profile.update(PCRASTER_VALUESCALE='VS_SCALAR', nodata=float(np.finfo(np.float32).min))
+        else:
+            dtype = np.result_type(base.dtype, np.float32)
+        if isinstance(multiplier, dict):
+            if self.zones is None:
+                raise ValueError(f'Zone multipliers for {mapname} need a zone map')
+            zones = self._zone_array()
+            if zones.shape != base.shape:
+                raise ValueError(f'{mapname} and {self.zones} have different shapes')
+            # Lookup table zone id -> multiplier, all other zones are kept
+            valid = zones >= 0
+            lut = np.ones(int(zones[valid].max(initial=0)) + 1, dtype=dtype)
+            for zone, value in multiplier.items():
+                if 0 <= int(zone) < len(lut):
+                    lut[int(zone)] = value
+            factor = lut[np.where(valid, zones, 0).astype(np.intp)]
+            factor[~valid] = 1
+        else:
+            factor = dtype.type(multiplier)
+        result = np.multiply(base, factor, dtype=dtype)
+        if nodata is not None:
+            result[base == nodata] = profile['nodata']
+        return result, dict(profile, dtype=dtype.name)
+
+    def write(self, target_dir, maps: dict) -> Path:
+        """
+        Creates a map directory for a single run. Changed maps are written, all other files are linked
+        to the original map directory (or copied, if the filesystem does not support links)
+
+        Args:
+            target_dir: The map directory of the run, usually in the result directory of the run
+            maps: dict of mapname -> multiplier
+
+        Returns:
+            The target directory
+        """
+        target_dir = Path(target_dir)
+        os.makedirs(target_dir, exist_ok=True)
+        for f in self.map_dir.iterdir():
+            target = target_dir / f.name
+            if f.name in maps or target.is_symlink() or not f.is_file():
+                continue
+            if target.exists():
+                # A map multiplied in an earlier run with the same name
+                target.unlink()
+            try:
+                os.symlink(f, target)
+            except OSError:
+                shutil.copy2(f, target)
+
+        for mapname, multiplier in maps.items():
+            array, profile = self.multiplied(mapname, multiplier)
+            target = target_dir / mapname
+            if target.is_symlink():
+                target.unlink()
+            with rasterio.open(target, 'w', **profile) as dst:
+                dst.write(array, 1)
+        return target_dir
@@ -0,0 +1,160 @@
+"""
+Reads several variables of a Lisem result file in one pass and aligns them to the time of an observation.
+"""
+import csv
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class ResultBundle:
+    """
+    Time aligned variables as a compact float32 array. Each row of `values` is one variable:
+
+    >>> bundle['Channels']
+    """
+    __slots__ = ('time', 'values', 'names')
+
+    def __init__(self, time: np.ndarray, values: np.ndarray, names: list):
+        self.time = time
+        self.values = values
+        self.names = list(names)
+
+    def __getitem__(self, name) -> np.ndarray:
+        return self.values[self.names.index(name)]
+
+    def __len__(self):
+        return len(self.time)
+
+    def __repr__(self):
+        return f'ResultBundle(names={self.names}, n={len(self)})'
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(dict(zip(self.names, self.values)), index=pd.Index(self.time, name='Time(min)'))
+
+
+class ResultExtractor:
+    """
+    Extracts variables by name from a Lisem result file ('totalseries.csv')
+
+    Usage:
+
+    >>> ex = ResultExtractor(['Channels', 'Detachment'], time_offset=1440)
+    >>> obs = ex.read_observation('observation.csv')
+    >>> sim = ex.read(lr['Result Directory'] + 'totalseries.csv', time=obs.time)
+    >>> efficiency(sim, obs)
+
+    Variables are found by their column header in the result file. The `columns` dict maps a variable
+    name to another header or to a column position, the defaults are the positions used by `LisemRunner.get_result`.
+    Cumulative variables are converted to the values per time step after the alignment.
+    """
+    columns = dict(Channels=10, Detachment=19, Deposition=20)
+
+    def __init__(self, variables=('Channels',), columns: dict = None, time_column='Time(min)',
+                 time_offset: float = 0.0, cumulative=('Channels',)):
+        """
+        Args:
+            variables: Names of the extracted variables
+            columns: Additional mapping of variable name -> header or column position
+            time_column: Header of the time column of the result file
+            time_offset: Subtracted from the simulation time, eg. 1440 min if the simulation starts a day earlier
+            cumulative: Variables stored as cumulative values in the result and the observation file
+        """
+        self.variables = list(variables)
+        self.columns = dict(self.columns, **(columns or {}))
+        self.time_column = time_column
+        self.time_offset = time_offset
+        self.cumulative = [v for v in cumulative if v in self.variables]
+
+    def _usecols(self, sim_file) -> list:
+        with open(sim_file, newline='') as f:
+            reader = csv.reader(f)
+            next(reader)
+            header = [h.strip() for h in next(reader)]
+        usecols = []
+        for name in [self.time_column] + self.variables:
+            if name in header:
+                usecols.append(header.index(name))
+                continue
+            column = self.columns.get(name)
+            if isinstance(column, str) and column in header:
+                usecols.append(header.index(column))
+            elif isinstance(column, int) and column < len(header):
+                usecols.append(column)
+            else:
+                raise KeyError(f'{name} not in {sim_file}')
+        return usecols
+
+    def _incremental(self, values: np.ndarray, names: list) -> np.ndarray:
+        rows = [names.index(v) for v in self.cumulative if v in names]
+        values[rows, 1:] = np.diff(values[rows], axis=1)
+        return values
+
+    def read(self, sim_file, time: np.ndarray = None) -> ResultBundle:
+        """
+        Reads the variables from the result file
+
+        Args:
+            sim_file: Path to the result file
+            time: Time of the observation. The variables are linearly interpolated to it,
+                values outside of the simulated time are nan. If None, the simulated time is used
+
+        Returns:
+            ResultBundle
+        """
+        logger.info('Load simulation file: %s', sim_file)
+        usecols = self._usecols(sim_file)
+        data = pd.read_csv(sim_file, skiprows=1, usecols=usecols).to_numpy(dtype=np.float64)
+        # usecols returns the columns in file order
+        data = data[:, np.argsort(np.argsort(usecols))]
+        sim_time = data[:, 0] - self.time_offset
+        if time is None:
+            time = sim_time
+            values = data[:, 1:].T.copy()
+        else:
+            time = np.asarray(time, dtype=np.float64)
+            values = np.array([np.interp(time, sim_time, v, left=np.nan, right=np.nan) for v in data[:, 1:].T])
+        values = self._incremental(values, self.variables)
+        return ResultBundle(time.astype(np.float32), values.astype(np.float32), self.variables)
+
+    def read_observation(self, obs_file, time_column='Time') -> ResultBundle:
+        """
+        Reads the observed variables of the extractor, that are available in the observation file
+
+        Returns:
+            ResultBundle
+        """
+        df = pd.read_csv(obs_file)
+        names = [v for v in self.variables if v in df.columns]
+        values = df[names].to_numpy(dtype=np.float64).T.copy()
+        values = self._incremental(values, names)
+        return ResultBundle(df[time_column].to_numpy(dtype=np.float32), values.astype(np.float32), names)
+
+
+def efficiency(sim: ResultBundle, obs: ResultBundle) -> pd.DataFrame:
+    """
+    Calculates NSE, pBias and KGE for all variables in both bundles. The bundles must have the same time,
+    eg. by reading the simulation with the time of the observation. Time steps with missing values are ignored.
+
+    Returns:
+        A dataframe with one row per variable
+    """
+    names = [n for n in obs.names if n in sim.names]
+    s = np.array([sim[n] for n in names], dtype=np.float64)
+    o = np.array([obs[n] for n in names], dtype=np.float64)
+    valid = ~(np.isnan(s) | np.isnan(o))
+    s = np.where(valid, s, np.nan)
+    o = np.where(valid, o, np.nan)
+    o_mean = np.nanmean(o, axis=1)
+    s_mean = np.nanmean(s, axis=1)
+    nse = 1 - np.nansum((s - o) ** 2, axis=1) / np.nansum((o - o_mean[:, None]) ** 2, axis=1)
+    pbias = (s_mean - o_mean) / o_mean * 100
+    o_std = np.nanstd(o, axis=1, ddof=1)
+    s_std = np.nanstd(s, axis=1, ddof=1)
+    r = np.nanmean((s - s_mean[:, None]) * (o - o_mean[:, None]), axis=1) / (
+        np.nanstd(s, axis=1) * np.nanstd(o, axis=1))
+    kge = 1 - np.sqrt((r - 1) ** 2 + (s_std / o_std - 1) ** 2 + (s_mean / o_mean - 1) ** 2)
+    return pd.DataFrame(dict(NSE=nse, pBias=pbias, KGE=kge), index=pd.Index(names, name='variable'))
@@ -0,0 +1,218 @@
+"""
+Memory saving storage of the simulations of a spotpy sampler.
+
+Use a store with the custom database format of spotpy, the setup forwards the results to the store:
+
+>>> setup = LisemSpot(..., store=TopNStore(100))
+>>> sampler = spotpy.algorithms.lhs(setup, dbformat='custom')
+>>> sampler.sample(100000)
+>>> setup.store.write('lisem.h5')
+>>> res, sim = read_store('lisem.h5')
+"""
+import heapq
+import zlib
+
+import numpy as np
+import pandas as pd
+import tables
+
+
+class SummaryStore:
+    """
+    Keeps the objective functions, the parameters and summary features of each run,
+    but no hydrographs. This is the base class of the stores with hydrographs.
+    """
+
+    def __init__(self, cumulative=True):
+        """
+        Args:
+            cumulative: The simulations are cumulative values (like the Channels of the result file) and
+                are converted to values per time step for the summary features
+        """
+        self.cumulative = cumulative
+        self.records = []
+
+    def features(self, simulation: np.ndarray) -> dict:
+        """
+        Summary features of a simulation: peak, time step of the peak and volume
+        """
+        q = np.asarray(simulation, dtype=np.float64)
+        if self.cumulative:
+            q = np.diff(q, prepend=0.0)
+        if not len(q) or np.isnan(q).all():
+            return dict(peak=np.nan, time_to_peak=-1, volume=np.nan)
+        return dict(peak=np.nanmax(q), time_to_peak=int(np.nanargmax(q)), volume=np.nansum(q))
+
+    def save(self, like, parameters: dict, simulation, **kwargs) -> int:
+        """
+        Stores a single run
+
+        Args:
+            like: The objective function value or a list of values
+            parameters: dict of parameter name -> value
+            simulation: The simulated array
+
+        Returns:
+            The id of the run
+        """
+        run_id = len(self.records)
+        like = np.atleast_1d(like)
+        record = {f'like{i + 1}': v for i, v in enumerate(like)}
+        record.update({f'par{k}': v for k, v in parameters.items()})
+        record.update(self.features(simulation))
+        self.records.append(record)
+        self._save_simulation(run_id, float(like[0]), simulation)
+        return run_id
+
+    def _save_simulation(self, run_id: int, score: float, simulation):
+        pass
+
+    def simulations(self) -> dict:
+        """
+        Returns:
+            dict of run id -> simulation of all stored hydrographs
+        """
+        return {}
+
+    def results(self) -> pd.DataFrame:
+        """
+        Returns:
+            A dataframe with the objective functions, parameters and features of each run
+        """
+        return pd.DataFrame(self.records)
+
+    def write(self, filename, complevel=9):
+        """
+        Writes the results and the stored hydrographs to a compressed HDF5 file, read it with `read_store`
+        """
+        self.results().to_hdf(filename, key='results', mode='w', complevel=complevel, complib='zlib')
+        self._write_simulations(filename, complevel)
+
+    def _write_simulations(self, filename, complevel):
+        simulations = self.simulations()
+        if simulations:
+            n = max(len(s) for s in simulations.values())
+            sim = np.full((len(simulations), n), np.nan, dtype=np.float32)
+            for i, s in enumerate(simulations.values()):
+                sim[i, :len(s)] = s
+            pd.DataFrame(sim, index=pd.Index(list(simulations), name='run')).to_hdf(
+                filename, key='simulations', mode='a', complevel=complevel, complib='zlib'
+            )
+
+
+class TopNStore(SummaryStore):
+    """
+    Keeps the full hydrographs as float32 only for the best n runs, ranked by the first objective function
+    """
+
+    def __init__(self, n: int, maximize=True, cumulative=True):
+        """
+        Args:
+            n: Number of kept hydrographs
+            maximize: If True (eg. NSE), the highest objective functions are the best runs
+            cumulative: See SummaryStore
+        """
+        super().__init__(cumulative)
+        self.n = n
+        self.maximize = maximize
+        # Min heap of (score, run_id, simulation), the worst kept run is the first item
+        self._heap = []
+
+    def _save_simulation(self, run_id: int, score: float, simulation):
+        if np.isnan(score):
+            return
+        score = score if self.maximize else -score
+        item = (score, run_id, np.asarray(simulation, dtype=np.float32))
+        if len(self._heap) < self.n:
+            heapq.heappush(self._heap, item)
+        elif score > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def simulations(self) -> dict:
+        return {run_id: sim for _, run_id, sim in sorted(self._heap, reverse=True)}
+
+
+class QuantisedStore(SummaryStore):
+    """
+    Keeps the hydrographs of all runs quantised to 16 bit and zlib compressed.
+    The quantisation error is at most half of 1/65534 of the range of each simulation.
+    """
+
+    def __init__(self, cumulative=True, level=6):
+        super().__init__(cumulative)
+        self.level = level
+        self._data = {}
+
+    def _save_simulation(self, run_id: int, score: float, simulation):
+        sim = np.asarray(simulation, dtype=np.float64)
+        finite = sim[~np.isnan(sim)]
+        vmin, vmax = (finite.min(), finite.max()) if finite.size else (0.0, 0.0)
+        scale = (vmax - vmin) / 65534 or 1.0
+        # 65535 marks nan
+        q = np.where(np.isnan(sim), 65535, np.round((sim - vmin) / scale)).astype(np.uint16)
+        self._data[run_id] = (vmin, scale, len(q), zlib.compress(q.tobytes(), self.level))
+
+    def _codes(self, run_id: int) -> np.ndarray:
+        return np.frombuffer(zlib.decompress(self._data[run_id][3]), dtype=np.uint16)
+
+    def simulation(self, run_id: int) -> np.ndarray:
+        """
+        Returns:
+            The restored float32 simulation of a run
+        """
+        vmin, scale = self._data[run_id][:2]
+        return _dequantise(self._codes(run_id), vmin, scale)
+
+    def simulations(self) -> dict:
+        return {run_id: self.simulation(run_id) for run_id in self._data}
+
+    def _write_simulations(self, filename, complevel):
+        """Writes the 16 bit codes run by run with the vmin and scale of each run"""
+        if not self._data:
+            return
+        n = max(length for _, _, length, _ in self._data.values())
+        filters = tables.Filters(complevel=complevel, complib='zlib')
+        with tables.open_file(filename, mode='a') as f:
+            group = f.create_group('/', 'quantised')
+            codes = f.create_earray(group, 'codes', tables.UInt16Atom(), shape=(0, n), filters=filters,
+                                    expectedrows=len(self._data))
+            row = np.empty((1, n), dtype=np.uint16)
+            for run_id in self._data:
+                q = self._codes(run_id)
+                row[0, :len(q)] = q
+                row[0, len(q):] = 65535
+                codes.append(row)
+            f.create_array(group, 'run', np.array(list(self._data), dtype=np.int64))
+            f.create_array(group, 'vmin', np.array([d[0] for d in self._data.values()], dtype=np.float64))
+            f.create_array(group, 'scale', np.array([d[1] for d in self._data.values()], dtype=np.float64))
+
+
+def _dequantise(q: np.ndarray, vmin, scale) -> np.ndarray:
+    # 65535 marks nan
+    return np.where(q == 65535, np.nan, vmin + q * scale).astype(np.float32)
+
+
+def read_store(filename, chunksize=1000):
+    """
+    Reads a file written by a simulation store. Quantised simulations are restored to float32
+    in chunks of chunksize runs.
+    Returns the result dataframe with objective function values, parameters and features (res)
+    and a dataframe of the stored simulations, indexed by the run id (the index of res).
+
+    Returns
+        res, sim
+    """
+    res = pd.read_hdf(filename, key='results')
+    with tables.open_file(filename, mode='r') as f:
+        if '/quantised' in f:
+            group = f.root.quantised
+            vmin, scale = group.vmin.read()[:, None], group.scale.read()[:, None]
+            sim = np.empty(group.codes.shape, dtype=np.float32)
+            # Dequantise in chunks to avoid float64 copies of all runs
+            for i in range(0, len(sim), chunksize):
+                sim[i:i + chunksize] = _dequantise(group.codes[i:i + chunksize], vmin[i:i + chunksize],
+                                                   scale[i:i + chunksize])
+            return res, pd.DataFrame(sim, index=pd.Index(group.run.read(), name='run'))
+    with pd.HDFStore(filename, mode='r') as f:
+        sim = f['simulations'] if '/simulations' in f.keys() else pd.DataFrame()
+    return res, sim
@@ -1,19 +1,90 @@
 from pathlib import Path
+from collections import deque
+import subprocess
+import time
 import pandas as pd
-from multiprocessing.pool import Pool
-from .lisemrunner import LisemRunner, nse
+import numpy as np
+from .lisemrunner import LisemRunner, nse, wait_usage
+from .resultextractor import efficiency
 
 import logging
 
+logger = logging.getLogger(__name__)
+
+
+class _Attempt:
+    """A single started Lisem process for a row of the table"""
+    def __init__(self, index, runner: LisemRunner, process: subprocess.Popen, runfile, speculative=False):
+        self.index = index
+        self.runner = runner
+        self.process = process
+        self.runfile = runfile
+        self.speculative = speculative
+        self.start = time.monotonic()
+        self.flagged = False
+        self.usage = None
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
 
 
 class TableRunner:
     """
     This class runs openlisem from a pandas dataframe, (eg. loaded from Excel), either sequentially
-    or parallel using multiprocessing
+    or parallel in up to ncores Lisem processes
+
+    In parallel mode the runtime of each finished run is recorded. A run taking longer than
+    straggler_factor times the median runtime is a straggler: it is either killed and restarted
+    (straggler_action='retry') or a duplicate is started in another result directory and the first
+    finished run is used (straggler_action='speculate'). The result table contains the runtime of the row
+    from the start of its first attempt, the runtime of the finished attempt (attempt_runtime), the number
+    of started attempts and flags for stragglers and timed out runs. Only finished attempts that are no
+    speculative duplicates count for the median runtime.
+
+    The peak memory (peak_rss, bytes), cpu time (s) and io_bytes of each run are recorded, where the os
+    supports it. With a memory_budget, the runner learns the peak memory of each runfile and starts a new
+    run only if the predicted memory of all running runs stays within the budget. Without a default_footprint,
+    a runfile without a measured peak memory runs only once at a time, until its first run has finished.
     """
-    def __init__(self, lisempath: Path, basepath: Path=None, ncores: int = 1):
+    def __init__(self, lisempath: Path, basepath: Path=None, ncores: int = 1,
+                 timeout: float = None, straggler_factor: float = None, straggler_action: str = 'speculate',
+                 max_attempts: int = 2, min_samples: int = 3, poll_interval: float = 1.0,
+                 memory_budget: float = None, default_footprint: float = None, extractor=None):
+        """
+        Args:
+            lisempath: Path to the Lisem executable
+            basepath: Base path of the runfiles in the table
+            ncores: Number of Lisem processes running at the same time
+            timeout: Maximum runtime of a run in seconds. Runs exceeding it are killed and recorded as timed out
+            straggler_factor: Multiple of the median runtime to flag a run as straggler. None disables the detection
+            straggler_action: 'retry' to kill and restart stragglers, 'speculate' to start a duplicate run
+            max_attempts: Maximum number of started attempts per row, including the first run
+            min_samples: Number of finished runs needed before stragglers are detected
+            poll_interval: Seconds between checks of the running processes
+            memory_budget: Maximum predicted memory of all running runs in bytes. None disables the admission control
+            default_footprint: Predicted memory in bytes of a runfile without finished runs. If None, only one run
+                of such a runfile is started at a time. Set it on systems without os.wait4 (Windows), where the
+                peak memory can not be measured
+            extractor: Optional ResultExtractor. If given, the Channels of the simulation are interpolated to the
+                time of the observation for NSE and pBias, instead of comparing them row by row
+        """
+        if straggler_action not in ('retry', 'speculate'):
+            raise ValueError(f'Unknown straggler action {straggler_action}, use retry or speculate')
         self.ncores = ncores
+        self.timeout = timeout
+        self.straggler_factor = straggler_factor
+        self.straggler_action = straggler_action
+        self.max_attempts = max_attempts
+        self.min_samples = min_samples
+        self.poll_interval = poll_interval
+        self.memory_budget = memory_budget
+        self.default_footprint = default_footprint
+        # Learned peak memory of each runfile
+        self.footprints = {}
+        self.extractor = extractor
         self.lisempath = Path(lisempath)
         if basepath:
             self.basepath = Path(basepath)
@@ -26,50 +97,197 @@ class TableRunner:
         else:
             return Path(path).absolute()
 
-    def _run(self, runfile, name, **parameters):
+    def _runner(self, runfile, name) -> LisemRunner:
         run_path = self._make_path(runfile)
         res_path = run_path.parent.parent / 'res'
-        lr = LisemRunner(self.lisempath, run_path, name, res_path)
-        return lr.run(**parameters)
+        return LisemRunner(self.lisempath, run_path, name, res_path, timeout=self.timeout)
 
-    def _run_row(self, row) -> tuple:
-        runfile, observation, name = row.iloc[:3]
-        return name, observation, self._run(runfile, name, **row.iloc[3:])
-    
     @staticmethod
     def _create_result_df(table):
         result_df = pd.DataFrame(table)
         result_df['NSE'] = float("nan")
         result_df['pBias'] = float("nan")
+        result_df['runtime'] = float("nan")
+        result_df['timed_out'] = False
+        for column in ('peak_rss', 'cpu_time', 'io_bytes'):
+            result_df[column] = float("nan")
         return result_df
+
+    def _objective(self, observation, lr: LisemRunner, result=None) -> tuple:
+        """NSE and pBias of a finished run, aligned by time if the runner has a result extractor"""
+        if self.extractor is None:
+            return nse(observation, lr.get_result() if result is None else result)
+        obs = self.extractor.read_observation(observation)
+        e = efficiency(lr.extract(self.extractor, obs.time), obs).loc['Channels']
+        return e.NSE, e.pBias
+
+    def _footprint(self, runfile):
+        """The predicted peak memory of a runfile, None if it is unknown"""
+        return self.footprints.get(self._make_path(runfile), self.default_footprint)
+
+    def _learn_footprint(self, runfile, usage: dict):
+        if usage and not np.isnan(usage['peak_rss']):
+            runfile = self._make_path(runfile)
+            self.footprints[runfile] = max(self.footprints.get(runfile, 0), usage['peak_rss'])
+
+    def _admit(self, index, row, running: list) -> bool:
+        """
+        Checks the memory budget for a new run. A single run is always admitted, a runfile with unknown
+        peak memory only if no run of another row with this runfile is running. Retries and duplicates
+        of a running row are not blocked by their own row
+        """
+        if self.memory_budget is None or not running:
+            return True
+        footprint = self._footprint(row.iloc[0])
+        if footprint is None:
+            runfile = self._make_path(row.iloc[0])
+            if any(a.runfile == runfile and a.index != index for a in running):
+                return False
+            footprint = 0.0
+        predicted = sum(self._footprint(a.runfile) or 0.0 for a in running) + footprint
+        return predicted <= self.memory_budget
     
-    def _run_row_objective(self, row_index_tuple):
-        index, row = row_index_tuple
+    def _start_attempt(self, index, row, result_df, speculative=False) -> _Attempt:
         runfile, observation, name = row.iloc[:3]
-        result = self._run(runfile, name, **row.iloc[3:])
-        NSE, pbias = nse(observation, result)
-        return dict(runfile=runfile, observation=observation, name=name, NSE=NSE, pBias=pbias)
+        attempt_no = result_df.loc[index, 'attempts']
+        if attempt_no:
+            # Each attempt needs its own runfile and result directory
+            name = f'{name}_attempt{attempt_no}'
+        lr = self._runner(runfile, name)
+        result_df.loc[index, 'attempts'] = attempt_no + 1
+        return _Attempt(index, lr, lr.start(**row.iloc[3:]), self._make_path(runfile), speculative)
+
+    def _straggler_limit(self, runtimes: list):
+        limits = []
+        if self.timeout:
+            limits.append(self.timeout)
+        if self.straggler_factor and len(runtimes) >= self.min_samples:
+            limits.append(self.straggler_factor * np.median(runtimes))
+        return min(limits, default=None)
 
     def _run_parallel(self, table: pd.DataFrame):
-        with Pool(self.ncores) as pool:
-            return pd.DataFrame(
-                pool.imap(self._run_row_objective, table.iterrows()),
-                index=table.index
-            )
+        result_df = self._create_result_df(table)
+        result_df['attempts'] = 0
+        result_df['straggler'] = False
+        result_df['attempt_runtime'] = float("nan")
+        # Restarts and speculative duplicates are started before new rows, both as (index, speculative)
+        queue = deque((index, False) for index in table.index)
+        restarts = deque()
+        running = []
+        runtimes = []
+        first_start = {}
+        done = set()
+
+        def finish(index):
+            done.add(index)
+            for other in [a for a in running if a.index == index]:
+                other.kill()
+                running.remove(other)
+
+        def admitted():
+            """
+            Removes the first waiting restart or new row within the memory budget.
+            A blocked restart does not block new rows
+            """
+            for waiting in (restarts, queue):
+                while waiting and waiting[0][0] in done:
+                    waiting.popleft()
+                if waiting and self._admit(waiting[0][0], table.loc[waiting[0][0]], running):
+                    return waiting.popleft()
+            return None
+
+        while queue or restarts or running:
+            while len(running) < self.ncores:
+                entry = admitted()
+                if entry is None:
+                    break
+                index, speculative = entry
+                running.append(self._start_attempt(index, table.loc[index], result_df, speculative))
+                first_start.setdefault(index, running[-1].start)
+            time.sleep(self.poll_interval)
+
+            for attempt in list(running):
+                # Skip duplicates killed by the finished run of their row
+                if attempt not in running or attempt.index in done:
+                    continue
+                attempt.usage = wait_usage(attempt.process, block=False)
+                if attempt.usage is None:
+                    continue
+                running.remove(attempt)
+                index = attempt.index
+                self._learn_footprint(table.loc[index].iloc[0], attempt.usage)
+                observation = table.loc[index].iloc[1]
+                try:
+                    NSE, pbias = self._objective(observation, attempt.runner)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning('%s failed: %s', attempt.runner, e)
+                    if not any(a.index == index for a in running) and not any(r[0] == index for r in restarts):
+                        finish(index)
+                    continue
+                now = time.monotonic()
+                attempt_runtime = now - attempt.start
+                runtime = now - first_start[index]
+                if not attempt.speculative:
+                    runtimes.append(attempt_runtime)
+                result_df.loc[index, ['NSE', 'pBias', 'runtime', 'attempt_runtime']] = NSE, pbias, runtime, attempt_runtime
+                for k, v in attempt.usage.items():
+                    result_df.loc[index, k] = v
+                logger.info('%s %s NSE=%s runtime=%0.1fs', index, attempt.runner.name, NSE, runtime)
+                finish(index)
+
+            limit = self._straggler_limit(runtimes)
+            now = time.monotonic()
+            for attempt in list(running):
+                if attempt not in running or attempt.index in done:
+                    continue
+                elapsed = now - attempt.start
+                index = attempt.index
+                if self.timeout and elapsed > self.timeout:
+                    logger.warning('%s timed out after %0.1fs', attempt.runner, elapsed)
+                    attempt.kill()
+                    running.remove(attempt)
+                    result_df.loc[index, 'timed_out'] = True
+                    if result_df.loc[index, 'attempts'] < self.max_attempts:
+                        restarts.append((index, False))
+                    elif not any(a.index == index for a in running):
+                        finish(index)
+                elif limit is not None and elapsed > limit and not attempt.flagged:
+                    attempt.flagged = True
+                    result_df.loc[index, 'straggler'] = True
+                    if result_df.loc[index, 'attempts'] >= self.max_attempts:
+                        continue
+                    logger.warning('%s is a straggler after %0.1fs, %s', attempt.runner, elapsed, self.straggler_action)
+                    if self.straggler_action == 'retry':
+                        attempt.kill()
+                        running.remove(attempt)
+                    restarts.append((index, self.straggler_action == 'speculate'))
+        return result_df
 
     def _run_sequential(self, table: pd.DataFrame):
         result_df = self._create_result_df(table)
         for index, row in table.iterrows():
-            name, observation, result = self._run_row(row)
-            NSE, pbias = nse(observation, result)
-            result_df['NSE'][index] = NSE
-            result_df['pBias'][index] = pbias
+            runfile, observation, name = row.iloc[:3]
+            lr = self._runner(runfile, name)
+            start = time.monotonic()
+            try:
+                result = lr.run(**row.iloc[3:])
+            except subprocess.TimeoutExpired:
+                result_df.loc[index, 'timed_out'] = True
+                print(index, name, 'timed out')
+                continue
+            finally:
+                self._learn_footprint(runfile, lr.usage)
+                for k, v in (lr.usage or {}).items():
+                    result_df.loc[index, k] = v
+            NSE, pbias = self._objective(observation, lr, result)
+            result_df.loc[index, ['NSE', 'pBias']] = NSE, pbias
+            result_df.loc[index, 'runtime'] = time.monotonic() - start
             print(index, name, NSE)
         return result_df
 
 
     def __call__(self, table: pd.DataFrame):
-        if self.ncores == 1:
+        if self.ncores == 1 and not self.straggler_factor:
             return self._run_sequential(table)
         else:
             return self._run_parallel(table)
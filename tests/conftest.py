@@ -0,0 +1,46 @@
+import sys
+import stat
+import importlib
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parents[1]
+# The repository is the package, import it by the name of its directory
+sys.path.insert(0, str(ROOT.parent))
+
+FAKE_LISEM = f'''#!{sys.executable}
+"""Writes a result file after sleeping the Delay of the runfile"""
+import sys
+import time
+from pathlib import Path
+
+runfile = dict(line.split('=', 1) for line in Path(sys.argv[2]).read_text().splitlines() if '=' in line)
+time.sleep(float(runfile['Delay'].replace(',', '.')))
+result = Path(runfile['Result Directory'])
+result.mkdir(parents=True, exist_ok=True)
+rows = [','.join(['Time(min)'] + [f'c{{i}}' for i in range(1, 10)] + ['Channels'])]
+rows += [','.join([str(t)] + ['0'] * 9 + [str(t * t)]) for t in range(10)]
+(result / 'totalseries.csv').write_text('\\n'.join(['Lisem fake'] + rows) + '\\n')
+'''
+
+
+@pytest.fixture
+def package():
+    return importlib.import_module(ROOT.name)
+
+
+@pytest.fixture
+def catchment(tmp_path):
+    """A fake Lisem executable, a template runfile with a Delay parameter and an observation file"""
+    lisem = tmp_path / 'Lisem'
+    lisem.write_text(FAKE_LISEM)
+    lisem.chmod(lisem.stat().st_mode | stat.S_IEXEC)
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir()
+    (run_dir / 'template.run').write_text(
+        'Result Directory=res/\nMap Directory=maps/\nAdvanced Options=0\nNr user Cores=0\nDelay=0\n'
+    )
+    observation = tmp_path / 'observation.csv'
+    observation.write_text('Time,Channels\n' + ''.join(f'{t},{t * t}\n' for t in range(10)))
+    return lisem, run_dir / 'template.run', observation
@@ -0,0 +1,28 @@
+import numpy as np
+import rasterio
+from affine import Affine
+
+
+def _write_map(path, array, valuescale):
+    profile = dict(driver='PCRaster', width=array.shape[1], height=array.shape[0], count=1, dtype=array.dtype.name,
+                   transform=Affine(10, 0, 0, 0, -10, 30), PCRASTER_VALUESCALE=valuescale)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(array, 1)
+
+
+def test_write_pcraster_maps(package, tmp_path):
+    from importlib import import_module
+    ParameterMaps = import_module(package.__name__ + '.parametermaps').ParameterMaps
+    map_dir = tmp_path / 'maps'
+    map_dir.mkdir()
+    _write_map(map_dir / 'ksat1.map', np.arange(12, dtype=np.float32).reshape(3, 4), 'VS_SCALAR')
+    _write_map(map_dir / 'landuse.map', np.array([[1, 1, 2, 2]] * 3, dtype=np.int32), 'VS_NOMINAL')
+    pm = ParameterMaps(map_dir, zones='landuse.map')
+    target = pm.write(tmp_path / 'run', {'ksat1.map': {1: 0.5, 2: 2.0}, 'landuse.map': 1.5})
+    with rasterio.open(target / 'ksat1.map') as src:
+        assert src.tags()['PCRASTER_VALUESCALE'] == 'VS_SCALAR'
+        assert np.allclose(src.read(1), np.arange(12).reshape(3, 4) * np.array([0.5, 0.5, 2.0, 2.0]))
+    with rasterio.open(target / 'landuse.map') as src:
+        # The multiplied nominal map has real values
+        assert src.tags()['PCRASTER_VALUESCALE'] == 'VS_SCALAR'
+        assert np.allclose(src.read(1), [[1.5, 1.5, 3.0, 3.0]] * 3)
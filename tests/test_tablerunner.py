@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+
+def _table(catchment, delays):
+    lisem, runfile, observation = catchment
+    return pd.DataFrame([dict(runfile=str(runfile), observation=str(observation), name=f'row{i}', Delay=delay)
+                         for i, delay in enumerate(delays)])
+
+
+def test_sequential_records_objective(package, catchment):
+    lisem = catchment[0]
+    result = package.TableRunner(lisem, ncores=1)(_table(catchment, [0.0, 0.0]))
+    assert np.allclose(result.NSE, 1.0)
+    assert np.allclose(result.pBias, 0.0)
+
+
+def test_original_beats_speculative_duplicate(package, catchment):
+    lisem = catchment[0]
+    table = _table(catchment, [0.2] * 7 + [2.0])
+    runner = package.TableRunner(lisem, ncores=3, straggler_factor=3, poll_interval=0.05)
+    result = runner(table)
+    assert np.allclose(result.NSE, 1.0)
+    assert result.straggler.iloc[-1]
+    assert result.attempts.iloc[-1] == 2
+    # The finished original run is not a speculative duplicate
+    assert result.runtime.iloc[-1] == result.attempt_runtime.iloc[-1]
+
+
+def test_duplicate_of_unknown_runfile_is_admitted(package, catchment):
+    lisem, runfile, observation = catchment
+    slow = runfile.with_name('slow.run')
+    slow.write_text(runfile.read_text())
+    table = _table(catchment, [0.2] * 7 + [2.0])
+    table.loc[7, 'runfile'] = str(slow)
+    runner = package.TableRunner(lisem, ncores=3, straggler_factor=3, poll_interval=0.05, memory_budget=1e12)
+    result = runner(table)
+    assert np.allclose(result.NSE, 1.0)
+    # The peak memory of slow.run is unknown until its first run has finished
+    assert result.attempts.iloc[-1] == 2
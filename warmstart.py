@@ -0,0 +1,119 @@
+"""
+An archive of previous calibration runs to warm start new calibrations.
+"""
+from pathlib import Path
+import threading
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class RunArchive:
+    """
+    Stores the result of each calibration run in a CSV file, indexed by catchment, runfile, objective and parameter.
+    The runfile and objective keys are hashes of their content (see LisemKOptimizer), and parameter values
+    are matched with the precision written to the runfile.
+
+    Usage:
+
+    >>> archive = RunArchive('calibration_runs.csv')
+    >>> opt = LisemKOptimizer(lr, obs_file, archive=archive, catchment='Reis2020')
+    >>> opt.opt_k(5, 15, 5)
+
+    Runs with a value already in the archive are not repeated, and the prior runs narrow the initial
+    range of the optimizers.
+    """
+    columns = ['catchment', 'runfile', 'objective', 'parameter', 'value', 'NSE', 'pBias']
+
+    def __init__(self, path, precision: int = 2):
+        """
+        Args:
+            path: The CSV file of the archive, created if it does not exist
+            precision: Number of decimals of the values in the runfile (see LisemRunner.precision).
+                Values with the same rounded value are the same run
+        """
+        self.path = Path(path)
+        self.precision = precision
+        # Runs of parallel threads are recorded one after the other
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self.df = pd.read_csv(self.path, dtype=dict(catchment=str, runfile=str, objective=str, parameter=str))
+        else:
+            self.df = pd.DataFrame(columns=self.columns)
+
+    def _runfile_value(self, value) -> float:
+        # Formatted like LisemRunner.__setitem__, eg. 1.995 -> 1.99, numpy rounding would give 2.0
+        return float(f'%0.{self.precision}f' % float(value))
+
+    def evaluations(self, catchment, runfile, objective, parameter, min_value=-np.inf, max_value=np.inf) -> pd.DataFrame:
+        """
+        Returns:
+            The prior runs of a parameter in the given range, sorted by the parameter value.
+            With runfile=None the runs of all runfiles of the catchment are returned
+        """
+        df = self.df
+        sel = (df.catchment == str(catchment)) & (df.objective == str(objective)) & (df.parameter == parameter)
+        if runfile is not None:
+            sel &= df.runfile == str(runfile)
+        sel &= (df.value >= min_value) & (df.value <= max_value)
+        return df[sel].sort_values('value')
+
+    def lookup(self, catchment, runfile, objective, parameter, value):
+        """
+        Returns:
+            NSE, pBias of a prior run with the same value in the runfile or None
+        """
+        prior = self.evaluations(catchment, runfile, objective, parameter)
+        prior = prior[prior.value.map(self._runfile_value) == self._runfile_value(value)]
+        if prior.empty:
+            return None
+        logger.info('Reuse %s=%s of %s', parameter, value, runfile)
+        row = prior.iloc[-1]
+        return row.NSE, row.pBias
+
+    def record(self, catchment, runfile, objective, parameter, value, nse, pbias):
+        """
+        Adds a run to the archive and appends it to the CSV file. The value is stored as written to the runfile
+        """
+        row = pd.DataFrame([dict(catchment=str(catchment), runfile=str(runfile), objective=str(objective),
+                                 parameter=parameter, value=self._runfile_value(value), NSE=nse, pBias=pbias)],
+                           columns=self.columns)
+        with self._lock:
+            row.to_csv(self.path, mode='a', header=not self.path.exists(), index=False)
+            self.df = pd.concat([self.df, row], ignore_index=True) if len(self.df) else row
+
+    def narrow(self, catchment, runfile, objective, parameter, min_value, max_value) -> tuple:
+        """
+        Narrows a search range to the neighbours of the best prior run (highest NSE) in the range.
+
+        Returns:
+            min_value, max_value
+        """
+        prior = self.evaluations(catchment, runfile, objective, parameter, min_value, max_value).dropna(subset=['NSE'])
+        if len(prior) < 3:
+            return min_value, max_value
+        values = prior.value.to_numpy()
+        best = int(np.argmax(prior.NSE.to_numpy()))
+        low = values[best - 1] if best > 0 else min_value
+        high = values[best + 1] if best < len(values) - 1 else max_value
+        logger.info('Warm start %s: [%s, %s] -> [%s, %s]', parameter, min_value, max_value, low, high)
+        return low, high
+
+    def bracket(self, catchment, runfile, objective, parameter, min_value, max_value):
+        """
+        Finds the tightest bracket of prior runs with a sign change of pBias in the range
+
+        Returns:
+            (low, high) or None
+        """
+        prior = self.evaluations(catchment, runfile, objective, parameter, min_value, max_value).dropna(subset=['pBias'])
+        values, pbias = prior.value.to_numpy(), prior.pBias.to_numpy()
+        change = np.flatnonzero(np.sign(pbias[:-1]) * np.sign(pbias[1:]) < 0)
+        if not len(change):
+            return None
+        i = change[np.argmin(values[change + 1] - values[change])]
+        logger.info('Warm start %s: bracket [%s, %s]', parameter, values[i], values[i + 1])
+        return values[i], values[i + 1]